@@ -1,5 +1,6 @@
 import os
 import sys
+from pathlib import Path
 
 from flat.core_lang.executor import Executor
 from flat.core_lang.instrumentor import Instrumentor
@@ -12,8 +13,7 @@ def compile_source(file_path: str):
         print(f'Error: file not found: {file_path}')
         sys.exit(1)
 
-    with open(file_path) as f:
-        inp = f.read()
+    inp = Path(file_path).read_text(encoding='utf-8')
     filename = os.path.abspath(file_path)
     try:
         program = parse_program(inp, filename)
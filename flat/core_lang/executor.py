@@ -4,14 +4,11 @@ from typing import Any
 
 from flat.core_lang.ast import *
 from flat.core_lang.predef import *
-
-
-def load(name: str) -> ast.Name:
-    return ast.Name(name, ctx=ast.Load())
+from flat.pyast import LOAD, STORE, load
 
 
 def store(name: str) -> ast.Name:
-    return ast.Name(name, ctx=ast.Store())
+    return ast.Name(name, ctx=STORE)
 
 
 def load_defs_to(m: ModuleType, env: dict[str, Any]) -> None:
@@ -88,7 +85,7 @@ class Executor:
             case Constant(Lit(value)):
                 return ast.Constant(value)
             case Var(Ident(name)):
-                return ast.Name(name, ctx=ast.Load())
+                return ast.Name(name, ctx=LOAD)
             case App(fun, args):
                 arguments = [self.visit_expr(e) for e in args]
                 match fun:
@@ -100,7 +97,7 @@ class Executor:
             case InLang(receiver, Ident(lang_name)):
                 word = self.visit_expr(receiver)
                 return ast.Compare(word, [ast.In()],
-                                   [ast.Attribute(load(lang_name), 'grammar', ctx=ast.Load())])
+                                   [ast.Attribute(load(lang_name), 'grammar', ctx=LOAD)])
             case Lambda(params, body):
                 args = ast.arguments([], [ast.arg(param.name) for param in params], None, [], [], None, [])
                 expr = self.visit_expr(body)
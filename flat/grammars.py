@@ -10,18 +10,29 @@ from isla.type_defs import Grammar as ISLaGrammar
 from flat.ast import (Rule, Clause, Token, Symbol, CharRange, Rep, Seq, Alt, RepExactly, RepInRange, Lit, Ident)
 
 
+_MAX_MEMBERS = 4096
+
+
 class Grammar:
     def __init__(self, name: str, clauses: dict[str, Clause], isla_grammar: ISLaGrammar):
         self.name = name
         self.clauses = clauses
         self.isla_solver = ISLaSolver(isla_grammar)
+        # word -> whether it is in the language: a value is often checked again, e.g. as an argument and a result
+        self._members: dict[str, bool] = {}
 
     def __contains__(self, word: str) -> bool:
-        try:
-            self.isla_solver.parse(word, skip_check=True, silent=True)
-            return True
-        except (SyntaxError, SemanticError):
-            return False
+        member = self._members.get(word)
+        if member is None:
+            try:
+                self.isla_solver.parse(word, skip_check=True, silent=True)
+                member = True
+            except (SyntaxError, SemanticError):
+                member = False
+            if len(self._members) >= _MAX_MEMBERS:  # fuzzing meets many distinct words: start afresh
+                self._members.clear()
+            self._members[word] = member
+        return member
 
     def parse(self, word: str) -> DerivationTree:
         return self.isla_solver.parse(word, skip_check=True, silent=True)
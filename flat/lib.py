@@ -1,6 +1,6 @@
-from typing import TypeVar, Callable
+from typing import TypeVar, Callable, Tuple
 
-from flat.selectors import XPath, select_by_xpath, xpath_parser
+from flat.selectors import XPath, XPathSelector, select_by_xpath, parse_xpath
 from flat.typing import LangType
 
 
@@ -13,11 +13,11 @@ T = TypeVar('T')
 
 
 def forall(f: Callable[[T], bool], xs: list[T]) -> bool:
-    return all(f(x) for x in xs)
+    return all(map(f, xs))
 
 
 def exists(f: Callable[[T], bool], xs: list[T]) -> bool:
-    return any(f(x) for x in xs)
+    return any(map(f, xs))
 
 
 def first(xs: list[T]) -> T:
@@ -29,16 +29,30 @@ def last(xs: list[T]) -> T:
 
 
 def xpath(language: LangType, selector: str) -> XPath:
-    return XPath(language, xpath_parser.parse(selector))
+    return XPath(language, parse_xpath(selector))
 
 
-def select_all(path: XPath, word: str) -> list[str]:
-    try:
-        root = path.language.grammar.parse(word)
-    except SyntaxError:
-        return []
+_MAX_SELECTIONS = 4096
+
+# (id of language, id of selectors, word) -> (language, selectors, selected words); `xpath` builds a new `XPath` per
+# call, but its language and (memoized) selectors are shared, so they identify the path
+_selections: dict[Tuple[int, int, str], Tuple[LangType, list[XPathSelector], Tuple[str, ...]]] = {}
 
-    return [tree.to_string() for tree in select_by_xpath(root, path)]
+
+def select_all(path: XPath, word: str) -> list[str]:
+    key = (id(path.language), id(path.selectors), word)
+    entry = _selections.get(key)
+    if entry is None or entry[0] is not path.language or entry[1] is not path.selectors:
+        try:
+            root = path.language.grammar.parse(word)
+        except SyntaxError:
+            selected = ()
+        else:
+            selected = tuple(tree.to_string() for tree in select_by_xpath(root, path))
+        if len(_selections) >= _MAX_SELECTIONS:  # specs meet many distinct words: start afresh
+            _selections.clear()
+        entry = _selections[key] = path.language, path.selectors, selected
+    return list(entry[2])  # a fresh list per call: specs may mutate it
 
 
 def select(path: XPath, word: str) -> str:
@@ -1,5 +1,6 @@
 import ast
 from dataclasses import dataclass
+from types import CodeType
 from typing import Any, Callable, Generator, Tuple, Literal
 
 import flat.parser
@@ -46,6 +47,7 @@ class PyCond(Cond):
                 self.expr = expr
             case _:
                 raise TypeError
+        self._code: Optional[CodeType] = None  # compiled on the first `apply`
 
     def __and__(self, other):
         if isinstance(other, PyCond):
@@ -53,8 +55,10 @@ class PyCond(Cond):
         raise TypeError
 
     def apply(self, value: Value) -> bool:
+        if self._code is None:  # refinements are checked for every value: compile once
+            self._code = compile(ast.Expression(self.expr), '<refinement>', 'eval')
         env = sys.modules['_.source'].__dict__
-        match eval(ast.unparse(self.expr), env, {'_': value}):
+        match eval(self._code, env, {'_': value}):
             case bool() as b:
                 return b
             case _:
@@ -78,10 +82,6 @@ def refine(base_type: type | LangType | RefinementType, refinement: str) -> Refi
         case _:
             raise TypeError
 
-    # from inspect import signature
-    # sig = signature(refinement)
-    # assert len(sig.parameters.keys()) == 1
-
 
 def list_of(elem_type: LangType | RefinementType) -> ListType:
     return ListType(elem_type)
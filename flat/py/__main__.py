@@ -1,9 +1,10 @@
 import argparse
 import os
 import sys
+from pathlib import Path
 
 from flat.errors import Error
-from flat.py.instrumentor import Instrumentor
+from flat.py.instrumentor import Instrumentor, unparse_to
 
 
 def instrument(file_path: str, out_dir: str):
@@ -13,14 +14,13 @@ def instrument(file_path: str, out_dir: str):
 
     os.makedirs(out_dir, exist_ok=True)
 
-    with open(file_path) as f:
-        code = f.read()
+    code = Path(file_path).read_bytes()
     instrumentor = Instrumentor()
-    output = instrumentor(os.path.abspath(file_path), code)
+    tree = instrumentor.instrument(os.path.abspath(file_path), code)
 
     base_name = os.path.basename(file_path)
-    with open(os.path.join(out_dir, base_name), 'w') as f:
-        f.write(output)
+    with open(os.path.join(out_dir, base_name), 'w', encoding='utf-8') as f:
+        unparse_to(tree, f)
 
 
 if __name__ == '__main__':
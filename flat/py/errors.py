@@ -1,11 +1,11 @@
 from dataclasses import dataclass
 from traceback import FrameSummary, walk_tb
-from typing import Tuple
+from typing import Optional, Tuple
 
 from flat.errors import Error
 
 
-@dataclass
+@dataclass(slots=True)
 class Loc:
     lineno: int
     col_offset: int
@@ -51,15 +51,19 @@ class TypeMismatch(Error):
         super().__init__('Type mismatch',
                          [f'expect:    {expected}', f'but found: {actual}'])
         self.loc = loc
+        self._summaries: Optional[list[FrameSummary]] = None
 
     def get_stack_frame(self) -> list[FrameSummary]:
-        # Stack: frame of this fun, frame of the target fun, ...
-        summaries = _extract_stack(self, 1)
-        assert summaries[-1].lineno == self.loc.lineno
-        summaries[-1].colno = self.loc.col_offset
-        summaries[-1].end_lineno = self.loc.end_lineno
-        summaries[-1].end_colno = self.loc.end_col_offset
-        return summaries
+        if self._summaries is None:
+            # Stack: frame of this fun, frame of the target fun, ...
+            summaries = _extract_stack(self, 1)
+            last = summaries[-1]
+            assert last.lineno == self.loc.lineno
+            self._summaries = [*summaries[:-1],
+                               FrameSummary(last.filename, last.lineno, last.name,
+                                            end_lineno=self.loc.end_lineno,
+                                            colno=self.loc.col_offset, end_colno=self.loc.end_col_offset)]
+        return self._summaries
 
 
 class ArgTypeMismatch(Error):
@@ -88,15 +92,17 @@ class PostconditionViolated(Error):
             f'outputs:', f'  {return_value}']
         super().__init__(f'Postcondition of method {method} violated', details)
         self.loc = return_value_loc
+        self._summaries: Optional[list[FrameSummary]] = None
 
     def get_stack_frame(self) -> list[FrameSummary]:
-        # Stack: frame of this fun, frame of the target fun, ...
-        summaries = _extract_stack(self, 1)
-        return_frame = FrameSummary(summaries[-1].filename, self.loc.lineno, summaries[-1].name,
-                                    end_lineno=self.loc.end_lineno,
-                                    colno=self.loc.col_offset, end_colno=self.loc.end_col_offset)
-        summaries.insert(-1, return_frame)
-        return summaries
+        if self._summaries is None:
+            # Stack: frame of this fun, frame of the target fun, ...
+            summaries = _extract_stack(self, 1)
+            return_frame = FrameSummary(summaries[-1].filename, self.loc.lineno, summaries[-1].name,
+                                        end_lineno=self.loc.end_lineno,
+                                        colno=self.loc.col_offset, end_colno=self.loc.end_col_offset)
+            self._summaries = [*summaries[:-1], return_frame, summaries[-1]]
+        return self._summaries
 
 
 class NoExpectedException(Error):
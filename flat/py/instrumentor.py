@@ -1,13 +1,19 @@
-from typing import get_origin, Literal
+import ast
+import builtins
+from copy import deepcopy
+from functools import lru_cache
+from importlib import import_module
+from typing import get_origin, Literal, TextIO
 
 from flat.py import fuzz as fuzz_annot, PyCond
 from flat.py.rewrite import cnf, ISLaConvertor, free_vars, subst
 from flat.py.runtime import *
 from flat.py.utils import classify
+from flat.pyast import LOAD, STORE, load
 from flat.typing import Type, RefinementType, LiteralType
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class FunSig:
     """Only interesting types are specified."""
     name: str
@@ -16,23 +22,99 @@ class FunSig:
     returns: Optional[Tuple[Type, ast.expr]]
     preconditions: list[ast.expr]  # bind params
     postconditions: list[ast.expr]  # bind params and '_' for return value
-
-    @property
-    def param_names(self) -> list[str]:
-        return [x for x, _, _ in self.params]
+    pre_conjuncts: list[ast.expr]  # conjuncts of the cnf of all preconditions
+    param_names: Tuple[str, ...]
+
+
+class SourceEnv(dict):
+    """Top-level namespace of a source module, resolved on demand.
+    Names bound only by the imports heading the module are imported without running the module;
+    looking up any other top-level name executes the module once, skipping only a bare `main()` call: other
+    top-level statements may have effects (e.g. on `sys.path`) that later definitions rely on.
+    The module is only analyzed on the first lookup, so sources that need no names cost nothing."""
+
+    def __init__(self, code: str | bytes):
+        super().__init__()
+        self._code = code
+        self._tree: Optional[ast.Module] = None  # parsed on demand: the instrumented tree is being mutated
+        self._executed = False
+        # name -> (module, attribute), for names bound by the imports heading the module
+        self._imports: dict[str, Tuple[str, Optional[str]]] = {}
+        self._submodules: dict[str, list[str]] = {}  # name -> submodules imported as `import name.sub`
+        self._bound: set[str] = set()  # names (possibly) bound by other statements
+        self._has_star_import = False
+
+    def _analyze(self) -> None:
+        self._tree = ast.parse(self._code)
+        only_imports = True  # names imported before any other statement can be imported without running it
+        for stmt in self._tree.body:
+            match stmt:
+                case ast.Import(aliases) if only_imports:
+                    for alias in aliases:
+                        if alias.asname:
+                            self._imports[alias.asname] = (alias.name, None)
+                        else:  # `import a.b` imports `a.b`, and binds `a`
+                            top = alias.name.split('.')[0]
+                            self._imports[top] = (top, None)
+                            if alias.name != top:
+                                self._submodules.setdefault(top, []).append(alias.name)
+                case ast.ImportFrom(module, aliases, 0) if only_imports and module is not None:
+                    for alias in aliases:
+                        if alias.name == '*':
+                            self._has_star_import = True
+                        else:
+                            self._imports[alias.asname or alias.name] = (module, alias.name)
+                case ast.Expr(ast.Constant(str())) if stmt is self._tree.body[0]:  # docstring
+                    pass
+                case ast.FunctionDef(x) | ast.AsyncFunctionDef(x) | ast.ClassDef(x):  # the body binds local names
+                    only_imports = False
+                    self._bound.add(x)
+                case _:
+                    only_imports = False
+                    for node in ast.walk(stmt):
+                        match node:
+                            case ast.Name(x, ast.Store()):
+                                self._bound.add(x)
+                            case ast.FunctionDef(x) | ast.AsyncFunctionDef(x) | ast.ClassDef(x):
+                                self._bound.add(x)
+                            case ast.Import(aliases) | ast.ImportFrom(_, aliases):
+                                self._bound.update((alias.asname or alias.name).split('.')[0] for alias in aliases)
+
+    def __missing__(self, name: str) -> Any:
+        if not self._executed:
+            if self._tree is None:
+                self._analyze()
+
+            if name in self._imports and name not in self._bound:
+                module, attr = self._imports[name]
+                for submodule in self._submodules.get(name, ()):
+                    import_module(submodule)
+                value = import_module(module)
+                if attr is not None:
+                    value = getattr(value, attr) if hasattr(value, attr) else import_module(f'{module}.{attr}')
+                self[name] = value
+                return value
+
+            if name in self._bound or name in self._imports or self._has_star_import:
+                self._executed = True
+                tree = self._tree
+                tree.body = [stmt for stmt in tree.body if not is_main_call(stmt)]
+                exec(compile(tree, '<source>', 'exec'), {}, self)
+                return self[name]
+
+        raise KeyError(name)
 
 
 class FunContext:
-    def __init__(self, fun: FunSig, annots: dict[str, ast.expr]):
+    __slots__ = ('fun', 'annots', 'args_info')
+
+    def __init__(self, fun: FunSig, annots: dict[str, ast.expr], args_info: list[ast.expr]):
         self.fun = fun
         self.annots = annots
+        self.args_info = args_info  # shared by all contract checks in the body
 
 
-def load(name: str) -> ast.Name:
-    return ast.Name(name, ctx=ast.Load())
-
-
-def const(value: int | str | None) -> ast.Constant:
+def const(value: int | str | tuple | None) -> ast.Constant:
     return ast.Constant(value)
 
 
@@ -46,25 +128,26 @@ def conjunction(conjuncts: list[ast.expr]) -> ast.expr:
             return ast.BoolOp(ast.And(), conjuncts)
 
 
-def assign(var: str, value: ast.expr | int) -> ast.stmt:
+def assign(var: str, value: ast.expr | int, lineno: int = 0) -> ast.stmt:
     if isinstance(value, int):
         value = ast.Constant(value)
 
-    return ast.Assign([ast.Name(var, ctx=ast.Store())], value)
+    # `ast.unparse` reads the line number of assignments (for type comments)
+    return ast.Assign([ast.Name(var, ctx=STORE)], value, lineno=lineno, end_lineno=lineno)
 
 
 def apply(fun: str | ast.expr, *args: int | str | ast.expr) -> ast.Call:
     if isinstance(fun, str):
         fun = load(fun)
+    expr, constant = ast.expr, ast.Constant  # bound once, not looked up per argument
     exprs = []
-    for arg in args:
-        match arg:
-            case int() as n:
-                exprs += [ast.Constant(n)]
-            case str() as s:
-                exprs += [ast.Constant(s)]
-            case ast.expr() as e:
-                exprs += [e]
+    for arg in args:  # plain isinstance tests: this runs for every emitted call
+        if isinstance(arg, expr):
+            exprs.append(arg)
+        elif isinstance(arg, (int, str)):
+            exprs.append(constant(arg))
+        else:
+            raise TypeError(f'cannot apply {ast.unparse(fun)} to {arg}')
     return ast.Call(fun, exprs, keywords=[])
 
 
@@ -72,15 +155,8 @@ def lambda_expr(args: list[str], body: ast.expr) -> ast.Lambda:
     return ast.Lambda(ast.arguments([], [ast.arg(x) for x in args], None, [], [], None, []), body)
 
 
-def apply_flat(fun: Callable, *args: int | str | ast.expr) -> ast.Call:
-    return apply(ast.Attribute(load('__flat__'), fun.__name__, ctx=ast.Load()), *args)
-
-
-def call_flat(fun: Callable, *args: int | str | ast.expr) -> ast.Expr:
-    return ast.Expr(apply_flat(fun, *args))
-
-
-def parse_expr(code: str) -> ast.expr:
+@lru_cache(maxsize=1024)
+def _parse_expr(code: str) -> ast.expr:
     match ast.parse(code).body[0]:
         case ast.Expr(expr):
             return expr
@@ -88,18 +164,31 @@ def parse_expr(code: str) -> ast.expr:
             raise TypeError
 
 
+def parse_expr(code: str) -> ast.expr:
+    return deepcopy(_parse_expr(code))  # callers may mutate the tree
+
+
+def is_positional_only(args: ast.arguments) -> bool:
+    """Lambda parameters like `lambda x, y: ...`: no defaults, no varargs, no keyword-only args."""
+    return not (args.posonlyargs or args.vararg or args.kwonlyargs or args.kwarg or args.defaults)
+
+
 def canonical_cond(condition: ast.expr, binders: list[str]) -> ast.expr:
-    match condition:
-        case ast.Constant(str() as literal):
-            return parse_expr(literal)
-        case ast.Lambda(ast.arguments([], args, None, [], [], None, []), body):
-            return subst(body, dict((arg.arg, load(x)) for arg, x in zip(args, binders)))
-        case _:
-            raise TypeError
+    if isinstance(condition, ast.Constant) and isinstance(condition.value, str):
+        return parse_expr(condition.value)
+    if isinstance(condition, ast.Lambda) and is_positional_only(condition.args):
+        return subst(condition.body, dict((arg.arg, load(x)) for arg, x in zip(condition.args.args, binders)))
+    raise TypeError
 
 
-def get_loc(node: ast.AST) -> ast.expr:
-    return apply_flat(Loc, node.lineno, node.col_offset, node.end_lineno, node.end_col_offset)
+def args_info(arg_names: list[str] | Tuple[str, ...]) -> list[ast.expr]:
+    """The arg names (as a constant tuple) and the tuple of their values, reported on contract violations."""
+    return [const(tuple(arg_names)), ast.Tuple([load(x) for x in arg_names], ctx=LOAD)]
+
+
+_SPEC_DECORATORS = frozenset({'requires', 'ensures', 'returns', 'raise_if'})
+_SPECIAL_CALLS = frozenset({'isinstance', 'fuzz'})
+_IMPORT_RUNTIME = ast.ImportFrom('flat.py', [ast.alias('runtime', '__flat__')], level=0)
 
 
 class Instrumentor(ast.NodeTransformer):
@@ -109,12 +198,34 @@ class Instrumentor(ast.NodeTransformer):
         self._next_id = 0
         self._case_guards: list[ast.expr] = []
         self._functions: dict[str, FunSig] = {}
+        # dispatch on node type directly, instead of NodeTransformer's per-node `getattr('visit_' + name)`
+        self._dispatch: dict[type, Callable[[Any], Any]] = dict(
+            (getattr(ast, name[len('visit_'):]), getattr(self, name))
+            for name in dir(self) if name.startswith('visit_') and hasattr(ast, name[len('visit_'):]))
+
+    def visit(self, node: ast.AST):
+        return self._dispatch.get(type(node), self.generic_visit)(node)
 
-    def __call__(self, source: str, code: str) -> str:
-        self._env: dict[str, Any] = {}
-        exec(code, {}, self._env)
+    def __call__(self, source: str, code: str | bytes) -> str:
+        return ast.unparse(self.instrument(source, code))
 
+    def instrument(self, source: str, code: str | bytes) -> ast.Module:
+        """Instrument the code of a source file. The result is meant for unparsing: synthesized nodes only carry
+        the line numbers `ast.unparse` reads, so call `ast.fix_missing_locations` before compiling it."""
         tree = ast.parse(code)
+        self._env: dict[str, Any] = SourceEnv(code)
+        self._expand_cache: dict[int, Optional[Type]] = {}  # id of annotation node -> its type
+        self._expand_code_cache: dict[str, Optional[Type]] = {}  # annotation code -> its type
+        self._convert = ISLaConvertor(self._env)
+        self._cnf_cache: dict[int, list[ast.expr]] = {}  # id of refinement condition -> its conjuncts
+        self._free_vars_cache: dict[int, frozenset[str]] = {}  # id of precondition conjunct -> its free vars
+        # (id of signature, custom producers) -> (signature, producer)
+        self._producer_cache: dict[Tuple[int, Tuple[Tuple[str, str], ...]], Tuple[FunSig, ast.expr]] = {}
+        self._loc_cache: dict[Tuple[int, int, int, int], ast.expr] = {}
+        # nodes shared within the emitted tree (`ast.unparse` only reads them), but never across trees
+        self._flat_attrs: dict[str, ast.Attribute] = {}  # runtime function name -> `__flat__.name`
+        self._line_target = ast.Name('__line__', ctx=STORE)  # target of all `__line__` updates
+
         self._last_lineno = 0
         self._stack: list[FunContext] = []
         self.filename = source
@@ -123,26 +234,56 @@ class Instrumentor(ast.NodeTransformer):
         except InstrumentError as err:
             err.print()
 
-        import_runtime = ast.parse('from flat.py import runtime as __flat__').body[0]
-        set_source = ast.parse(f'__source__ = "{self.filename}"').body[0]
-        tree.body.insert(0, import_runtime)
-        tree.body.insert(1, set_source)
-        tree.body.insert(2, call_flat(load_source_module, ast.Name('__source__')))
-        tree.body.append(call_flat(run_main, load('main')))
-        ast.fix_missing_locations(tree)
-        return ast.unparse(tree)
+        tree.body.insert(0, deepcopy(_IMPORT_RUNTIME))
+        tree.body.insert(1, assign('__source__', const(self.filename)))
+        tree.body.insert(2, self.call_flat(load_source_module, load('__source__')))
+        tree.body.append(self.call_flat(run_main, load('main')))
+        return tree
+
+    def flat_attr(self, name: str) -> ast.Attribute:
+        attr = self._flat_attrs.get(name)
+        if attr is None:
+            attr = self._flat_attrs[name] = ast.Attribute(load('__flat__'), name, ctx=LOAD)
+        return attr
 
-    def track_lineno(self, lineno: int) -> list[ast.stmt]:
+    def apply_flat(self, fun: Callable, *args: int | str | ast.expr) -> ast.Call:
+        return apply(self.flat_attr(fun.__name__), *args)
+
+    def call_flat(self, fun: Callable, *args: int | str | ast.expr) -> ast.Expr:
+        return ast.Expr(self.apply_flat(fun, *args))
+
+    def check_type(self, value: ast.expr, loc: ast.expr, annot: ast.expr) -> ast.Expr:
+        """Emit `assert_type(value, loc, annot)`. Checks are emitted at almost every site, so build the call
+        directly rather than dispatching on each argument in `apply`."""
+        return ast.Expr(ast.Call(self.flat_attr('assert_type'), [value, loc, annot], keywords=[]))
+
+    def check_arg_type(self, value: ast.expr, k: int, of_method: str, annot: ast.expr) -> ast.Expr:
+        """Emit `assert_arg_type(value, k, of_method, annot)`."""
+        return ast.Expr(ast.Call(self.flat_attr('assert_arg_type'),
+                                 [value, ast.Constant(k), ast.Constant(of_method), annot], keywords=[]))
+
+    def track_lineno(self, lineno: int, body: list[ast.stmt]) -> list[ast.stmt]:
+        """Append a `__line__` update to `body` (if the line changes), and return `body`."""
         # assert self._inside_body
-        body = []
         if lineno != self._last_lineno:
-            body += [assign('__line__', lineno)]
+            body.append(ast.Assign([self._line_target], ast.Constant(lineno), lineno=lineno, end_lineno=lineno))
             self._last_lineno = lineno
 
         return body
 
     def expand(self, annot: ast.expr) -> Optional[Type]:
-        match eval(ast.unparse(annot), {}, self._env):
+        # annotations are not mutated during instrumentation, so each node is evaluated at most once
+        key = id(annot)
+        if key not in self._expand_cache:
+            # and annotations spelled the same, like a repeated `refine(...)`, share one evaluation
+            code = annot.id if isinstance(annot, ast.Name) else ast.unparse(annot)
+            if code not in self._expand_code_cache:
+                self._expand_code_cache[code] = self._expand(annot)
+            self._expand_cache[key] = self._expand_code_cache[code]
+        return self._expand_cache[key]
+
+    def _expand(self, annot: ast.expr) -> Optional[Type]:
+        match eval_annot(annot, self._env):
             case Type() as typ:
                 return typ
             case other:
@@ -153,6 +294,29 @@ class Instrumentor(ast.NodeTransformer):
                     return LiteralType(values)
                 return None
 
+    def conjuncts_of(self, cond: PyCond) -> list[ast.expr]:
+        # conditions are shared by every use of the refinement type
+        key = id(cond)
+        if key not in self._cnf_cache:
+            self._cnf_cache[key] = cnf(cond.expr)
+        return self._cnf_cache[key]
+
+    def loc_of(self, node: ast.AST) -> ast.expr:
+        # one shared `Loc(...)` node per source range: all checks on the same expression reuse it, so callers must
+        # not mutate it
+        key = (node.lineno, node.col_offset, node.end_lineno, node.end_col_offset)
+        loc = self._loc_cache.get(key)
+        if loc is None:
+            loc = self._loc_cache[key] = self.apply_flat(Loc, *key)
+        return loc
+
+    def free_vars_of(self, cond: ast.expr) -> frozenset[str]:
+        # precondition conjuncts are tested once per param of each fuzzed function
+        key = id(cond)
+        if key not in self._free_vars_cache:
+            self._free_vars_cache[key] = free_vars(cond)
+        return self._free_vars_cache[key]
+
     def fresh_name(self) -> str:
         self._next_id += 1
         return f'_{self._next_id}'
@@ -183,9 +347,9 @@ class Instrumentor(ast.NodeTransformer):
             raise self.error(f"missing required positional argument: '{name}'", from_call)
         return None
 
-    def visit_FunctionDef(self, node: ast.FunctionDef):
+    def visit_FunctionDef(self, node: ast.FunctionDef) -> list[ast.stmt]:
         # self._inside_body = True
-        body = self.track_lineno(node.lineno)
+        body = self.track_lineno(node.lineno, [])
         annots = {}
 
         # check arg types
@@ -196,7 +360,7 @@ class Instrumentor(ast.NodeTransformer):
                 typ = self.expand(arg.annotation)
                 if typ:
                     annots[x] = arg.annotation
-                    body += [call_flat(assert_arg_type, load(x), len(params), node.name, arg.annotation)]
+                    body.append(self.check_arg_type(load(x), len(params), node.name, arg.annotation))
             else:
                 typ = None
             params.append((x, typ, arg.annotation))
@@ -220,41 +384,47 @@ class Instrumentor(ast.NodeTransformer):
         preconditions: list[ast.expr] = []
         postconditions: list[ast.expr] = []
         exc_info: list[ast.Tuple] = []  # cond_var name, exc_type, loc
-        processed: list[ast.expr] = []
+        processed: set[int] = set()  # ids of processed decorators
         arg_names = [x for x, _, _ in params]
+        info = args_info(arg_names)  # params don't change inside the function: shared by all its checks
         for decorator in node.decorator_list:
+            if not (isinstance(decorator, ast.Call) and isinstance(decorator.func, ast.Name)
+                    and decorator.func.id in _SPEC_DECORATORS):
+                continue  # cheap bail-out for unrelated decorators
+
             match decorator:
                 case ast.Call(ast.Name('requires'), [condition]):
                     pre = canonical_cond(condition, arg_names)
                     preconditions.append(pre)
-                    body += self.track_lineno(decorator.lineno)
-                    body += [call_flat(assert_pre, pre,
-                                       ast.List([ast.Tuple([const(x), load(x)]) for x in arg_names]), node.name)]
-                    processed.append(decorator)  # to remove it
+                    self.track_lineno(decorator.lineno, body)
+                    body.append(self.call_flat(assert_pre, pre, *info, node.name))
+                    processed.add(id(decorator))  # to remove it
                 case ast.Call(ast.Name('ensures'), [condition]):
                     post = canonical_cond(condition, arg_names + ['_'])
                     post.lineno = decorator.lineno
                     postconditions.append(post)
-                    processed.append(decorator)  # to remove it
+                    processed.add(id(decorator))  # to remove it
                 case ast.Call(ast.Name('returns'), [value]):
                     value = canonical_cond(value, arg_names)
                     post = ast.Compare(load('_'), [ast.Eq()], [value])
                     post.lineno = decorator.lineno
                     postconditions.append(post)
-                    processed.append(decorator)  # to remove it
+                    processed.add(id(decorator))  # to remove it
                 case ast.Call(ast.Name('raise_if')) as call:
                     exc_type = self.extract_arg(0, 'exc', True, call)
                     cond = canonical_cond(self.extract_arg(1, 'cond', True, call), arg_names)
                     cond_var = f'__exc_cond_{len(exc_info)}__'
-                    body += [assign(cond_var, cond)]
-                    exc_info.append(ast.Tuple([load(cond_var), exc_type, get_loc(decorator)]))
-                    processed.append(decorator)  # to remove it
+                    body.append(assign(cond_var, cond, decorator.lineno))
+                    exc_info.append(ast.Tuple([load(cond_var), exc_type, self.loc_of(decorator)], ctx=LOAD))
+                    processed.add(id(decorator))  # to remove it
 
-        for x in processed:
-            node.decorator_list.remove(x)
+        if len(processed) > 0:
+            node.decorator_list = [d for d in node.decorator_list if id(d) not in processed]
 
         # signature done
-        sig = FunSig(node.name, params, defaults, returns, preconditions, postconditions)
+        pre_conjuncts = [c for pre in preconditions for c in cnf(pre)]
+        sig = FunSig(node.name, params, defaults, returns, preconditions, postconditions, pre_conjuncts,
+                     tuple(arg_names))
         self._functions[node.name] = sig
 
         # transform body
@@ -263,22 +433,18 @@ class Instrumentor(ast.NodeTransformer):
         else:  # no wrap
             body_buffer = body
 
-        self._stack.append(FunContext(sig, annots))
-        for stmt in node.body:
-            match self.visit(stmt):
-                case ast.stmt() as s:
-                    body_buffer.append(s)
-                case list() as ss:
-                    body_buffer += ss
+        self._stack.append(FunContext(sig, annots, info))
+        for stmt in node.body:  # statement visitors all return lists
+            body_buffer += self.visit(stmt)
         self._stack.pop()
 
         if len(exc_info) > 0:
-            handler = apply_flat(ExpectExceptions, ast.List([t for t in exc_info]))
+            handler = self.apply_flat(ExpectExceptions, ast.Tuple(exc_info, ctx=LOAD))
             with_item = ast.withitem(handler)
-            with_stmt = ast.With([with_item], body_buffer, type_ignores=[])
+            with_stmt = ast.With([with_item], body_buffer, lineno=node.lineno, end_lineno=node.end_lineno)
             body.append(with_stmt)
         node.body = body
-        return node
+        return [node]
 
     def visit_Assign(self, node: ast.Assign) -> list[ast.stmt]:
         node.value = self.visit(node.value)
@@ -286,12 +452,16 @@ class Instrumentor(ast.NodeTransformer):
             return [node]
 
         ctx = self._stack[-1]
-        body = self.track_lineno(node.lineno)
-        body += [node]
+        body = self.track_lineno(node.lineno, [])
+        body.append(node)
+        annots = ctx.annots
+        if not annots:  # nothing to check
+            return body
+
         for target in node.targets:
             for var in vars_in_target(target):
-                if var in ctx.annots:
-                    body += [call_flat(assert_type, node.value, get_loc(node.value), ctx.annots[var])]
+                if var in annots:
+                    body.append(self.check_type(node.value, self.loc_of(node.value), annots[var]))
 
         return body
 
@@ -302,62 +472,63 @@ class Instrumentor(ast.NodeTransformer):
             return [node]
 
         ctx = self._stack[-1]
-        body = self.track_lineno(node.lineno)
-        body += [node]
+        body = self.track_lineno(node.lineno, [])
+        body.append(node)
         match node.target:
             case ast.Name(var):
                 if self.expand(node.annotation) is not None:
                     ctx.annots[var] = node.annotation
-                    body += [call_flat(assert_type, node.value, get_loc(node.value), ctx.annots[var])]
+                    body.append(self.check_type(node.value, self.loc_of(node.value), ctx.annots[var]))
             case _:
                 raise TypeError
 
         return body
 
-    def visit_AugAssign(self, node: ast.AugAssign):
+    def visit_AugAssign(self, node: ast.AugAssign) -> list[ast.stmt]:
         node.value = self.visit(node.value)
         if len(self._stack) == 0:
             return [node]
 
         ctx = self._stack[-1]
-        body = self.track_lineno(node.lineno)
-        body += [node]
-        match node.target:
-            case ast.Name(var):
-                if var in ctx.annots:
-                    body += [call_flat(assert_type, node.value, get_loc(node.value), ctx.annots[var])]
+        body = self.track_lineno(node.lineno, [])
+        body.append(node)
+        target = node.target
+        if ctx.annots and isinstance(target, ast.Name) and target.id in ctx.annots:
+            body.append(self.check_type(node.value, self.loc_of(node.value), ctx.annots[target.id]))
 
         return body
 
-    def visit_Return(self, node: ast.Return):
+    def visit_Return(self, node: ast.Return) -> list[ast.stmt]:
         if node.value:
             node.value = self.visit(node.value)
         else:
             node.value = const(None)
 
         ctx = self._stack[-1]
-        body = self.track_lineno(node.lineno)
+        body = self.track_lineno(node.lineno, [])
         if ctx.fun.returns is None and len(ctx.fun.postconditions) == 0:  # no check, just return
-            return body + [node]
+            body.append(node)
+            return body
 
-        body += [assign('__return__', node.value)]
+        body.append(assign('__return__', node.value, node.lineno))
         if ctx.fun.returns:
-            body += [call_flat(assert_type, load('__return__'), get_loc(node.value), ctx.fun.returns[1])]
+            body.append(self.check_type(load('__return__'), self.loc_of(node.value), ctx.fun.returns[1]))
 
-        arg_names = [x for x in ctx.fun.param_names]
         for cond in ctx.fun.postconditions:  # note: return value is '_' in cond
-            body += self.track_lineno(cond.lineno)
-            body += [call_flat(assert_post, subst(cond, {'_': load('__return__')}),
-                               ast.List([ast.Tuple([const(x), load(x)]) for x in arg_names]),
-                               load('__return__'), get_loc(node.value), const(ctx.fun.name))]
-        body += self.track_lineno(node.lineno)
-        body += [ast.Return(load('__return__'))]
+            self.track_lineno(cond.lineno, body)
+            body.append(self.call_flat(assert_post, subst(cond, {'_': load('__return__')}), *ctx.args_info,
+                                  load('__return__'), self.loc_of(node.value), const(ctx.fun.name)))
+        self.track_lineno(node.lineno, body)
+        body.append(ast.Return(load('__return__')))
         return body
 
     def visit_Call(self, node: ast.Call):
+        if not (isinstance(node.func, ast.Name) and node.func.id in _SPECIAL_CALLS):  # most calls
+            return super().generic_visit(node)
+
         match node:
             case ast.Call(ast.Name('isinstance'), [obj, typ]) if self.expand(typ) is not None:
-                return apply_flat(has_type, obj, typ)
+                return self.apply_flat(has_type, obj, typ)
             case ast.Call(ast.Name('fuzz')) as call if self._env['fuzz'] == fuzz_annot:
                 fun = None
                 target = self.extract_arg(0, 'target', True, call)
@@ -386,28 +557,32 @@ class Instrumentor(ast.NodeTransformer):
                                     raise self.error('expect argument name', key)
                     case other:
                         raise self.error('expect dict', other)
-                return apply_flat(fuzz, target, times, self._producer(fun, using))
+                # the call site passes its location, for tracebacks through `fuzz`
+                fuzz_call = self.apply_flat(fuzz, target, times, self._producer(fun, using))
+                fuzz_call.keywords = [ast.keyword('source', load('__source__')),
+                                      ast.keyword('line', load('__line__'))]
+                return fuzz_call
             case _:
                 return super().generic_visit(node)
 
-    def visit_Match(self, node: ast.Match):
+    def visit_Match(self, node: ast.Match) -> list[ast.stmt]:
         node.subject = self.visit(node.subject)
         new_cases = []
         for case in node.cases:
             self._case_guards = []
             case = self.visit(case)
             if len(self._case_guards) > 0:
-                cond = ast.BoolOp(ast.And(), self._case_guards)
+                cond = conjunction(self._case_guards)
                 case.guard = cond if case.guard is None else ast.BoolOp(ast.And(), [case.guard, cond])
             new_cases.append(case)
         node.cases = new_cases
 
-        return node
+        return [node]
 
     def visit_MatchAs(self, node: ast.MatchAs):
         match node:
             case ast.MatchAs(ast.MatchClass(cls, [], [], []), x) if self.expand(cls) is not None:
-                self._case_guards.append(apply_flat(has_type, load(x), cls))
+                self._case_guards.append(self.apply_flat(has_type, load(x), cls))
                 return ast.MatchAs(None, x)
             case _:
                 return super().generic_visit(node)
@@ -416,38 +591,46 @@ class Instrumentor(ast.NodeTransformer):
         match node:
             case ast.MatchClass(cls, [], [], []) if self.expand(cls) is not None:
                 x = self.fresh_name()
-                self._case_guards.append(apply_flat(has_type, load(x), cls))
+                self._case_guards.append(self.apply_flat(has_type, load(x), cls))
                 return ast.MatchAs(None, x)
             case _:
                 return super().generic_visit(node)
 
     def generic_visit(self, node: ast.AST):
         if isinstance(node, ast.stmt):
-            body = self.track_lineno(node.lineno)
-            match super().generic_visit(node):
-                case ast.stmt() as s:
-                    body.append(s)
-                case list() as ss:
-                    body += ss
+            if cannot_raise(node):  # no traceback can point at it: keep `__line__` as is
+                return [node]
+
+            body = self.track_lineno(node.lineno, [])
+            body.append(super().generic_visit(node))  # transforms the children in place
             return body
 
         return super().generic_visit(node)
 
     def _producer(self, fun: FunSig, using_producers: dict[str, ast.expr]) -> ast.expr:
-        pre_conjuncts = [c for pre in fun.preconditions for c in cnf(pre)]
-        convert = ISLaConvertor(self._env)
+        # fuzzing the same function with the same custom producers yields the same producer
+        # (keyed by the signature, not the name: a name can be redefined with another signature)
+        key = (id(fun), tuple((x, ast.dump(using_producers[x])) for x in sorted(using_producers)))
+        entry = self._producer_cache.get(key)
+        if entry is None or entry[0] is not fun:
+            entry = self._producer_cache[key] = fun, self._synth_producer(fun, using_producers)
+        return deepcopy(entry[1])
+
+    def _synth_producer(self, fun: FunSig, using_producers: dict[str, ast.expr]) -> ast.expr:
+        pre_conjuncts = fun.pre_conjuncts
+        convert = self._convert
 
         producers: list[ast.expr] = []
         for x, typ, annot in fun.params:
             if x in using_producers:
                 producers += [using_producers[x]]
             elif x in fun.defaults:  # use default value
-                producers += [apply_flat(constant_generator, fun.defaults[x])]
+                producers += [self.apply_flat(constant_generator, fun.defaults[x])]
             elif typ and typ.is_lang_type:  # synthesize an isla producer
                 formulae: list[str] = []  # conjuncts that isla can solve
                 test_conditions: list[ast.expr] = []  # other conjuncts: fall back to Python
                 if isinstance(typ, RefinementType) and isinstance(typ.cond, PyCond):
-                    for cond in cnf(typ.cond.expr):
+                    for cond in self.conjuncts_of(typ.cond):
                         match convert(cond, '_'):
                             case None:
                                 test_conditions += [cond]
@@ -456,8 +639,8 @@ class Instrumentor(ast.NodeTransformer):
 
                 # pick conjuncts that could be written in the refinement position
                 # i.e., it is a predicate over the param x only
-                picked, pre_conjuncts = classify(lambda c: free_vars(c) & (set(fun.param_names) - {x}) == set(),
-                                                 pre_conjuncts)
+                others = frozenset(fun.param_names) - {x}
+                picked, pre_conjuncts = classify(lambda c: self.free_vars_of(c).isdisjoint(others), pre_conjuncts)
                 for cond in picked:
                     match convert(cond, x):
                         case None:
@@ -475,29 +658,90 @@ class Instrumentor(ast.NodeTransformer):
 
                 assert annot is not None
                 if isinstance(typ, RefinementType):
-                    annot = ast.Attribute(annot, 'base', ctx=ast.Load())
-                producers += [
-                    apply_flat(producer,
-                               apply_flat(isla_generator, annot, formula),
-                               lambda_expr(['_'], conjunction(test_conditions)))
-                ]
+                    annot = ast.Attribute(annot, 'base', ctx=LOAD)
+                generator = self.apply_flat(isla_generator, annot, formula)
+                if len(test_conditions) > 0:
+                    generator = self.apply_flat(producer, generator, lambda_expr(['_'], conjunction(test_conditions)))
+                producers += [generator]  # with nothing to test, values come straight from the solver
             elif isinstance(typ, LiteralType):
                 if len(typ.values) == 1:
-                    producers += [apply_flat(constant_generator, typ.values[0])]
+                    producers += [self.apply_flat(constant_generator, typ.values[0])]
                 else:
-                    producers += [apply_flat(choice_generator, ast.List([ast.Constant(v) for v in typ.values]))]
+                    producers += [self.apply_flat(choice_generator, ast.List([ast.Constant(v) for v in typ.values], ctx=LOAD))]
             else:
                 raise TypeError(f'must specify producer for param {x}, specified are {using_producers}')
 
-        return apply_flat(product_producer, ast.List(producers),
-                          lambda_expr(fun.param_names, conjunction(pre_conjuncts)))
+        if len(pre_conjuncts) == 0:  # no test on the combined values
+            return self.apply_flat(product_producer, ast.List(producers, ctx=LOAD))
+        return self.apply_flat(product_producer, ast.List(producers, ctx=LOAD),
+                          lambda_expr(list(fun.param_names), conjunction(pre_conjuncts)))
+
+
+def unparse_to(tree: ast.Module, out: TextIO) -> None:
+    """Write `ast.unparse(tree)` to `out`, one top-level statement at a time."""
+    for i, stmt in enumerate(tree.body):
+        if i > 0:  # same separators as `ast.unparse`: a blank line before definitions
+            out.write('\n\n' if isinstance(stmt, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)) else '\n')
+        out.write(ast.unparse(stmt))
+
+
+def cannot_raise(stmt: ast.stmt) -> bool:
+    """Statements that neither raise nor call anything, e.g., `pass` and docstrings."""
+    match stmt:
+        case ast.Pass() | ast.Break() | ast.Continue() | ast.Global() | ast.Nonlocal() | ast.Expr(ast.Constant()):
+            return True
+        case _:
+            return False
 
 
-def vars_in_target(expr: ast.expr) -> list[str]:
+def is_main_call(stmt: ast.stmt) -> bool:
+    """Is `stmt` a bare `main()` call, i.e. the entry point of the program rather than part of its definitions?"""
+    match stmt:
+        case ast.Expr(ast.Call(ast.Name('main'), [], [])):
+            return True
+        case _:
+            return False
+
+
+def vars_in_target(expr: ast.expr, out: Optional[list[str]] = None) -> list[str]:
+    """Variables bound by an assignment target, collected into `out`. Only the destructuring nodes are
+    descended into: attribute and subscript targets bind no variable."""
+    if out is None:
+        out = []
     match expr:
         case ast.Name(x):
-            return [x]
-        case ast.Tuple(es):
-            return [x for e in es for x in vars_in_target(e)]
-        case _:
-            return []
+            out.append(x)
+        case ast.Tuple(elts) | ast.List(elts):
+            for elt in elts:
+                vars_in_target(elt, out)
+        case ast.Starred(value):
+            vars_in_target(value, out)
+    return out
+
+
+def eval_annot(annot: ast.expr, env: dict[str, Any]) -> Any:
+    """Evaluate a type annotation in `env` like `eval(ast.unparse(annot), {}, env)` does, but walk the common
+    shapes (names, attributes, calls, subscripts and constants) directly, and compile the others without
+    unparsing and reparsing them."""
+    match annot:
+        case ast.Name(x):
+            try:
+                return env[x]
+            except KeyError:
+                if hasattr(builtins, x):
+                    return getattr(builtins, x)
+                raise NameError(f"name '{x}' is not defined")
+        case ast.Attribute(value, attr):
+            return getattr(eval_annot(value, env), attr)
+        case ast.Constant(value):
+            return value
+        case ast.Call(func, args, keywords) if all(kw.arg is not None for kw in keywords) and \
+                                                not any(isinstance(arg, ast.Starred) for arg in args):
+            return eval_annot(func, env)(*[eval_annot(arg, env) for arg in args],
+                                         **{kw.arg: eval_annot(kw.value, env) for kw in keywords})
+        case ast.Subscript(value, index) if not isinstance(index, ast.Slice):
+            return eval_annot(value, env)[eval_annot(index, env)]
+        case ast.Tuple(elts) if not any(isinstance(elt, (ast.Starred, ast.Slice)) for elt in elts):
+            return tuple(eval_annot(elt, env) for elt in elts)
+        case _:  # compile the node as is: `compile` does not mutate it
+            return eval(compile(ast.Expression(annot), '<annotation>', 'eval'), {}, env)
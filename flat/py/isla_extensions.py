@@ -1,9 +1,37 @@
+from typing import Optional, Tuple
+
 from isla.derivation_tree import DerivationTree
 from isla.language import StructuralPredicate
 from isla.type_defs import Path
 
 from flat.selectors import children_labelled_with
 
+# The solver evaluates the predicates for many (node, parent) pairs of the same tree: remember the labelled
+# children of each parent, for the most recent tree only.
+_children_tree: Optional[DerivationTree] = None
+_children_cache: dict[Tuple[Path, str], list[DerivationTree]] = {}
+
+
+def _subtree(tree: DerivationTree, path: Path) -> DerivationTree:
+    # walk down from `tree` itself: `DerivationTree.get_subtree` is cached by tree equality, and may thus return
+    # a node of another (equal) tree, which breaks the identity tests below
+    for i in path:
+        tree = tree.children[i]
+    return tree
+
+
+def _children_at(tree: DerivationTree, parent_path: Path, symbol: str) -> list[DerivationTree]:
+    global _children_tree
+    if tree is not _children_tree:
+        _children_tree = tree
+        _children_cache.clear()
+
+    key = (parent_path, symbol)
+    children = _children_cache.get(key)
+    if children is None:
+        children = _children_cache[key] = children_labelled_with(_subtree(tree, parent_path), symbol)
+    return children
+
 
 def ebnf_direct_child(tree: DerivationTree, path: Path, parent_path: Path) -> bool:
     """
@@ -12,9 +40,9 @@ def ebnf_direct_child(tree: DerivationTree, path: Path, parent_path: Path) -> bo
     :param path: the path of the testing node.
     :param parent_path: the path of the parent node.
     """
-    node = tree.get_subtree(path)
-    children = children_labelled_with(tree.get_subtree(parent_path), node.root_nonterminal()[1:-1])
-    return node in children
+    node = _subtree(tree, path)
+    children = _children_at(tree, parent_path, node.root_nonterminal()[1:-1])
+    return any(child is node for child in children)  # not `in`: that compares whole subtrees
 
 
 EBNF_DIRECT_CHILD = StructuralPredicate('ebnf_direct_child', 2, ebnf_direct_child)
@@ -28,10 +56,10 @@ def ebnf_kth_child(tree: DerivationTree, path: Path, parent_path: Path, k: str |
     :param parent_path: the path of the parent node.
     :param k: the position, starting at 1.
     """
-    node = tree.get_subtree(path)
-    children = children_labelled_with(tree.get_subtree(parent_path), node.root_nonterminal()[1:-1])
+    node = _subtree(tree, path)
+    children = _children_at(tree, parent_path, node.root_nonterminal()[1:-1])
     if len(children) >= int(k):
-        return node == children[int(k) - 1]
+        return children[int(k) - 1] is node
     return False
 
 
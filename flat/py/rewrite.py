@@ -1,70 +1,132 @@
 import ast
-from copy import deepcopy
+from copy import copy
 from enum import Enum
-from typing import Callable, Optional, Tuple, Any
+from functools import lru_cache
+from typing import Any, Callable, Iterable, Iterator, Optional, Tuple
 
 from flat.py.isla_extensions import EBNF_DIRECT_CHILD, EBNF_KTH_CHILD
 from flat.selectors import *
 
 
 def negate(cond: ast.expr) -> ast.expr:
-    """Logical negation of a condition."""
-    return ast.UnaryOp(ast.Not(), cond)
+    """Logical negation of a condition. Double negations cancel out."""
+    match cond:
+        case ast.UnaryOp(ast.Not(), operand):
+            return operand
+        case _:
+            return ast.UnaryOp(ast.Not(), cond)
 
 
 def cnf(cond: ast.expr) -> list[ast.expr]:
     """Convert a condition into conjunctive normal form. Return the list of conjuncts."""
-    match cond:
-        case ast.BoolOp(ast.And(), operands):  # p and q
-            return [c for e in operands for c in cnf(e)]
-        case ast.UnaryOp(ast.Not(), ast.BoolOp(ast.Or(), operands)):  # not (p or q) = (not p) and (not q)
-            return [c for e in operands for c in cnf(negate(e))]
-        case atomic:
-            return [atomic]
+    return simplify_conjuncts(iter_conjuncts(cond))
+
+
+def iter_conjuncts(cond: ast.expr) -> Iterator[ast.expr]:
+    """Yield the conjuncts of a condition one at a time, as they are reached."""
+    stack = [(cond, False)]  # (condition, whether it is negated): negations are only built for atomic conjuncts
+    while stack:
+        match stack.pop():
+            case ast.BoolOp(ast.And(), operands), False:  # p and q
+                stack.extend((e, False) for e in reversed(operands))
+            case ast.BoolOp(ast.Or(), operands), True:  # not (p or q) = (not p) and (not q)
+                stack.extend((e, True) for e in reversed(operands))
+            case ast.UnaryOp(ast.Not(), operand), negated:  # flip the polarity, so not not p = p
+                stack.append((operand, not negated))
+            case atomic, False:
+                yield atomic
+            case atomic, True:
+                yield negate(atomic)
+
+
+def ast_key(node: Any) -> Any:
+    """A hashable structural key of an AST: equal exactly when `ast.dump` shows the same, but no text is built."""
+    if isinstance(node, ast.AST):
+        return (type(node),) + tuple(ast_key(getattr(node, field, None)) for field in node._fields)
+    if isinstance(node, list):
+        return tuple(ast_key(x) for x in node)
+    return type(node), node  # so that 1 and True differ
+
+
+def simplify_conjuncts(conjuncts: Iterable[ast.expr]) -> list[ast.expr]:
+    """Drop true and duplicate conjuncts; collapse to false if some conjunct is false or contradicts another.
+    Stop consuming the conjuncts at the first false one."""
+    simplified = []
+    seen: set = set()  # keys of the kept conjuncts
+    for conjunct in conjuncts:
+        match conjunct:
+            case ast.Constant(True):
+                continue
+            case ast.Constant(False):
+                return [conjunct]
+        key = ast_key(conjunct)
+        if key not in seen:
+            seen.add(key)
+            simplified.append(conjunct)
+
+    for conjunct in simplified:  # p and not p
+        match conjunct:
+            case ast.UnaryOp(ast.Not(), operand) if ast_key(operand) in seen:
+                return [ast.Constant(False)]
+    return simplified
 
 
-class FreeVarCollector(ast.NodeVisitor):
+class FreeVarCollector:
     def __call__(self, tree: ast.expr) -> frozenset[str]:
         """Collect the set of free variable names in an expression."""
-        self._free: set[str] = set()
-        self._bound: list[list[str]] = []
-        self.visit(tree)
-        return frozenset(self._free)
-
-    def visit_Name(self, node: ast.Name):
-        if all(node.id not in bound for bound in self._bound):
-            self._free.add(node.id)
-
-    def visit_Lambda(self, node: ast.Lambda):
-        bound = [arg.arg for arg in node.args.args]
-        self._bound.append(bound)
-        self.visit(node.body)
-        self._bound.pop()
+        free: set[str] = set()
+        stack: list[Tuple[ast.AST, Tuple[str, ...]]] = [(tree, ())]  # (node, names bound in its scope)
+        while stack:
+            node, bound = stack.pop()
+            match node:
+                case ast.Name(x):
+                    if x not in bound:
+                        free.add(x)
+                case ast.Lambda(args, body):
+                    stack.append((body, bound + tuple(arg.arg for arg in args.args)))
+                case _:
+                    stack.extend((child, bound) for child in ast.iter_child_nodes(node))
+        return frozenset(free)
 
 
 free_vars: Callable[[ast.expr], frozenset[str]] = FreeVarCollector()
 
 
-class Substitution(ast.NodeTransformer):
+class Substitution:
     def __call__(self, tree: ast.expr, subst_map: dict[str, ast.expr]) -> ast.expr:
-        """Substitute free vars in an expression."""
+        """Substitute free vars in an expression.
+        The input is not modified: only the nodes above a substituted variable are copied, the rest is shared."""
         self._subst_map = subst_map
-        self._bound: list[list[str]] = []
-        node = deepcopy(tree)
-        self.visit(node)
-        return node
-
-    def visit_Name(self, node: ast.Name) -> ast.expr:
-        if node.id in self._subst_map and all(node.id not in bound for bound in self._bound):
-            return self._subst_map[node.id]
-        return node
-
-    def visit_Lambda(self, node: ast.Lambda) -> ast.expr:
-        bound = [arg.arg for arg in node.args.args]
-        self._bound.append(bound)
-        body = self.visit(node.body)
-        self._bound.pop()
-        node.body = body
+        return self._subst(tree, ())
+
+    def _subst(self, node: ast.AST, bound: Tuple[str, ...]) -> ast.AST:
+        if isinstance(node, ast.Name):
+            if node.id in self._subst_map and node.id not in bound:
+                return self._subst_map[node.id]
+            return node
+
+        if isinstance(node, ast.Lambda):  # only the body is in the scope of the params
+            bound = bound + tuple(arg.arg for arg in node.args.args)
+            fields = [('body', node.body)]
+        else:
+            fields = ast.iter_fields(node)
+
+        changed: dict[str, Any] = {}
+        for field, value in fields:
+            if isinstance(value, list):
+                new_value = [self._subst(child, bound) if isinstance(child, ast.AST) else child for child in value]
+                if any(new is not old for new, old in zip(new_value, value)):
+                    changed[field] = new_value
+            elif isinstance(value, ast.AST):
+                new_value = self._subst(value, bound)
+                if new_value is not value:
+                    changed[field] = new_value
+
+        if not changed:
+            return node
+        node = copy(node)
+        for field, value in changed.items():
+            setattr(node, field, value)
         return node
 
 
@@ -77,121 +139,162 @@ class ISLaType(Enum):
     String = 2
 
 
+# operators are dispatched on their class: one dict lookup instead of a case per operator
+_CONNECTIVES: dict[type, str] = {ast.And: ' and ', ast.Or: ' or '}
+_ARITH_OPS: dict[type, str] = {ast.Add: '+', ast.Sub: '-', ast.Mult: '*', ast.Div: '/', ast.Mod: '%'}
+# comparisons: formula templates over (lhs, rhs); strings are only ordered by `<=` in SMTLib
+_INT_COMPARISONS: dict[type, str] = {
+    ast.Eq: '(= {0} {1})',
+    ast.Lt: '(< {0} {1})',
+    ast.LtE: '(<= {0} {1})',
+    ast.Gt: '(> {0} {1})',
+    ast.GtE: '(>= {0} {1})',
+}
+_STRING_COMPARISONS: dict[type, str] = {
+    ast.Eq: '(= {0} {1})',
+    ast.Lt: '((<= {0} {1}) and not (= {0} {1}))',
+    ast.LtE: '(<= {0} {1})',
+    ast.Gt: '(not (<= {0} {1}))',
+    ast.GtE: '(not (<= {0} {1}) or (= {0} {1}))',
+    ast.In: '(str.contains {1} {0})',
+}
+
+# calls that may be translated: other calls are rejected without trying each case below
+_ISLA_FUNCTIONS = frozenset({'len', 'ord', 'chr', 'int', 'str', 'select', 'selected_all', 'selected_any'})
+_ISLA_METHODS = frozenset({'startswith', 'endswith', 'find', 'index', 'replace', 'isdigit'})
+
+
 class ISLaConvertor:
     def __init__(self, env: dict[str, Any]) -> None:
         self._env: dict[str, Any] = env
         self.this: str = '_'
         self.ty_ctx: dict[str, ISLaType] = {}
+        # (id of expr, this) -> (expr, formula): a refinement condition is converted once for all its uses
+        self._cache: dict[Tuple[int, str], Tuple[ast.expr, Optional[str]]] = {}
+        # (dump of expr, this) -> formula: conditions spelled the same, like canonical preconditions, share one
+        self._dump_cache: dict[Tuple[str, str], Optional[str]] = {}
+        self._xpaths: dict[str, Any] = {}  # dump of xpath expr -> its value in env
+        self._dispatch: dict[type, Callable[[Any], Optional[Tuple[str, ISLaType]]]] = {
+            ast.Constant: self._constant,
+            ast.Name: self._name,
+            ast.BoolOp: self._bool_op,
+            ast.UnaryOp: self._unary_op,
+            ast.BinOp: self._bin_op,
+            ast.Compare: self._compare,
+            ast.Subscript: self._subscript,
+            ast.Call: self._call,
+        }
 
     def __call__(self, expr: ast.expr, this: str) -> Optional[str]:
         """Convert an expression to a well-typed ISLa formula."""
-        self.this = this
-        self.ty_ctx = {}
-        result = self.to_isla(expr)
-        if result:
-            return result[0]
-        return None
+        key = (id(expr), this)
+        entry = self._cache.get(key)
+        if entry is not None and entry[0] is expr:
+            return entry[1]
+
+        dump_key = (ast.dump(expr), this)
+        if dump_key in self._dump_cache:
+            formula = self._dump_cache[dump_key]
+        else:
+            self.this = this
+            self.ty_ctx = {}
+            result = self.to_isla(expr)
+            formula = result[0] if result else None
+            self._dump_cache[dump_key] = formula
+        self._cache[key] = expr, formula
+        return formula
 
     def to_isla(self, expr: ast.expr) -> Optional[Tuple[str, ISLaType]]:
+        # dispatch on the node class: other kinds of expressions are never translated
+        convert = self._dispatch.get(type(expr))
+        if convert is None:
+            return None
+        return convert(expr)
+
+    def _constant(self, expr: ast.Constant) -> Optional[Tuple[str, ISLaType]]:
         match expr:
-            # constants
             case ast.Constant(True):
                 return 'true', ISLaType.Formula
             case ast.Constant(False):
                 return 'false', ISLaType.Formula
             case ast.Constant(int() as n):
                 return str(n), ISLaType.Int
-            case ast.Constant(str()):
-                return '"' + ast.unparse(expr)[1:-1] + '"', ISLaType.String  # NOTE: isla uses double quote
+            case ast.Constant(str() as s):  # the escapes of `repr`, as `ast.unparse` produces them
+                return '"' + repr(s)[1:-1] + '"', ISLaType.String  # NOTE: isla uses double quote
+        return None
 
-            # bound variables
+    def _name(self, expr: ast.Name) -> Optional[Tuple[str, ISLaType]]:
+        # bound variables
+        match expr:
             case ast.Name(x) if x in self.ty_ctx:
                 return x, self.ty_ctx[x]
+        return None
 
-            # boolean expressions
+    def _bool_op(self, expr: ast.BoolOp) -> Optional[Tuple[str, ISLaType]]:
+        # boolean expressions
+        match expr:
             case ast.BoolOp(op, operands):
-                match op:
-                    case ast.And():
-                        connective = ' and '
-                    case ast.Or():
-                        connective = ' or '
-                    case _:
-                        assert False
-                results = [self.to_isla(e) for e in operands]
-                if all(isinstance(result, tuple) and result[1] == ISLaType.Formula for result in results):
-                    formulae = [f for f, _ in results]  # type: ignore
-                    return '(' + connective.join(formulae) + ')', ISLaType.Formula
+                connective = _CONNECTIVES[type(op)]
+                formulae = []
+                for e in operands:  # give up on the first operand that is not a formula
+                    match self.to_isla(e):
+                        case (formula, ISLaType.Formula):
+                            formulae.append(formula)
+                        case _:
+                            return None
+                return '(' + connective.join(formulae) + ')', ISLaType.Formula
+        return None
+
+    def _unary_op(self, expr: ast.UnaryOp) -> Optional[Tuple[str, ISLaType]]:
+        match expr:
             case ast.UnaryOp(ast.Not(), operand):
                 match self.to_isla(operand):
                     case (formula, ISLaType.Formula):
                         return f'(not {formula})', ISLaType.Formula
+            case ast.UnaryOp(op, operand):
+                match op, self.to_isla(operand):
+                    case ast.UAdd(), (formula, ISLaType.Int):
+                        return formula, ISLaType.Int  # type: ignore
+                    case ast.USub(), (formula, ISLaType.Int):
+                        return f'(- 0 {formula})', ISLaType.Int
+        return None
 
-            # arithmetic expressions, string concat (+)
+    def _bin_op(self, expr: ast.BinOp) -> Optional[Tuple[str, ISLaType]]:
+        # arithmetic expressions, string concat (+)
+        match expr:
             case ast.BinOp(left, op, right):
-                match op:
-                    case ast.Add():
-                        smt_op = '+'
-                    case ast.Sub():
-                        smt_op = '-'
-                    case ast.Mult():
-                        smt_op = '*'
-                    case ast.Div():
-                        smt_op = '/'
-                    case ast.Mod():
-                        smt_op = '%'
-                    case _:  # unsupported
-                        return None
+                smt_op = _ARITH_OPS.get(type(op))
+                if smt_op is None:  # unsupported
+                    return None
                 match self.to_isla(left), self.to_isla(right):
                     case (lhs, ISLaType.Int), (rhs, ISLaType.Int):
                         return f'({smt_op} {lhs} {rhs})', ISLaType.Int
                     case ((lhs, ISLaType.String), (rhs, ISLaType.String)) if smt_op == '+':
                         return f'(str.++ {lhs} {rhs})', ISLaType.String
-            case ast.UnaryOp(op, operand):
-                match op, self.to_isla(operand):
-                    case ast.UAdd(), (formula, ISLaType.Int):
-                        return formula, ISLaType.Int  # type: ignore
-                    case ast.USub(), (formula, ISLaType.Int):
-                        return f'(- 0 {formula})', ISLaType.Int
+        return None
 
-            # comparison expressions, string comparison (<=), string contains (in)
+    def _compare(self, expr: ast.Compare) -> Optional[Tuple[str, ISLaType]]:
+        # comparison expressions, string comparison (<=), string contains (in)
+        match expr:
             case ast.Compare(left, [op], [right]):
-                match op:
-                    case ast.Eq():
-                        smt_op = '='
-                    case ast.Lt():
-                        smt_op = '<'
-                    case ast.LtE():
-                        smt_op = '<='
-                    case ast.Gt():
-                        smt_op = '>'
-                    case ast.GtE():
-                        smt_op = '>='
-                    case ast.In():
-                        smt_op = 'in'
-                    case _:  # unsupported
-                        return None
+                int_template = _INT_COMPARISONS.get(type(op))
+                string_template = _STRING_COMPARISONS.get(type(op))
+                if string_template is None:  # unsupported
+                    return None
                 match self.to_isla(left), self.to_isla(right):
-                    case (lhs, ISLaType.Int), (rhs, ISLaType.Int) if smt_op != 'in':
-                        return f'({smt_op} {lhs} {rhs})', ISLaType.Formula
+                    case (lhs, ISLaType.Int), (rhs, ISLaType.Int) if int_template is not None:
+                        return int_template.format(lhs, rhs), ISLaType.Formula
                     case (lhs, ISLaType.String), (rhs, ISLaType.String):
-                        match smt_op:
-                            case '<':
-                                return f'((<= {lhs} {rhs}) and not (= {lhs} {rhs}))', ISLaType.Formula
-                            case '>':
-                                return f'(not (<= {lhs} {rhs}))', ISLaType.Formula
-                            case '>=':
-                                return f'(not (<= {lhs} {rhs}) or (= {lhs} {rhs}))', ISLaType.Formula
-                            case 'in':
-                                return f'(str.contains {rhs} {lhs})', ISLaType.Formula
-                            case _:
-                                return f'({smt_op} {lhs} {rhs})', ISLaType.Formula
-
-            # string char at
+                        return string_template.format(lhs, rhs), ISLaType.Formula
+        return None
+
+    def _subscript(self, expr: ast.Subscript) -> Optional[Tuple[str, ISLaType]]:
+        # string char at, substring
+        match expr:
             case ast.Subscript(receiver, ast.Constant(int() as index)):
                 match self.to_isla(receiver):
                     case string, ISLaType.String:
                         return f'(str.at {string} {index})', ISLaType.String
-            # substring
             case ast.Subscript(receiver, ast.Slice(lower, upper, step=None)):
                 match self.to_isla(receiver):
                     case string, ISLaType.String:
@@ -210,9 +313,18 @@ class ISLaConvertor:
                             case _:  # unsupported
                                 return None
                         return f'(str.substr {string} {offset} {length})', ISLaType.String
+        return None
+
+    def _eval_xpath(self, xpath: ast.expr) -> Any:
+        key = ast.dump(xpath)
+        if key not in self._xpaths:
+            self._xpaths[key] = eval(ast.unparse(xpath), {}, self._env)
+        return self._xpaths[key]
 
-            # string and builtin functions
-            case ast.Call(ast.Name(fun, ctx=ast.Load()), args, keywords=[]):
+    def _call(self, expr: ast.Call) -> Optional[Tuple[str, ISLaType]]:
+        # string and builtin functions
+        match expr:
+            case ast.Call(ast.Name(fun, ctx=ast.Load()), args, keywords=[]) if fun in _ISLA_FUNCTIONS:
                 match fun, args:
                     case 'len', [receiver]:
                         match self.to_isla(receiver):
@@ -239,11 +351,11 @@ class ISLaConvertor:
                                 # Python: allow negative value.
                                 return f'(str.from_int {integer})', ISLaType.String
                     case 'select', [_, ast.Constant(str() as path), ast.Name(w)] if w == self.this:
-                        return xpath_to_isla_expr(xpath_parser.parse(path), 'start'), ISLaType.String
+                        return xpath_to_isla_expr(parse_xpath(path), 'start'), ISLaType.String
                     case 'selected_all' | 'selected_any', \
                          [ast.Lambda(ast.arguments([], [ast.arg(x)], None, [], [], None, []), cond),
                           xpath, ast.Name(w)] if w == self.this:
-                        path = eval(ast.unparse(xpath), {}, self._env)
+                        path = self._eval_xpath(xpath)
                         assert isinstance(path, XPath)
                         self.ty_ctx[x] = ISLaType.String
                         result = self.to_isla(cond)
@@ -252,7 +364,7 @@ class ISLaConvertor:
                             formula = xpath_to_isla_formula(path, fun == 'selected_all', x, result[0])
                             return formula, ISLaType.Formula
 
-            case ast.Call(ast.Attribute(receiver, fun, ctx=ast.Load()), args, keywords=[]):
+            case ast.Call(ast.Attribute(receiver, fun, ctx=ast.Load()), args, keywords=[]) if fun in _ISLA_METHODS:
                 match fun, args:
                     case 'startswith', [s]:
                         match self.to_isla(receiver), self.to_isla(s):
@@ -292,17 +404,23 @@ class ISLaConvertor:
                                 # SMTLib: require the string to be a singleton.
                                 # Python: test all characters in the string.
                                 return f'(str.is_digit {string})', ISLaType.Formula
-
-        # otherwise
         return None
 
 
 def xpath_to_isla_formula(path: XPath, is_universal: bool, atomic_binder: str, atomic_cond: str) -> str:
-    formula = atomic_cond
+    prefix, suffix = _xpath_quantifiers(tuple(path.selectors), is_universal, atomic_binder)
+    return prefix + atomic_cond + suffix
+
+
+@lru_cache(maxsize=256)
+def _xpath_quantifiers(selectors: Tuple[XPathSelector, ...], is_universal: bool,
+                       atomic_binder: str) -> Tuple[str, str]:
+    """The quantifiers around the atomic condition, as the text before and after it."""
+    formula = '\0'  # placeholder for the atomic condition
     quantifier = 'forall' if is_universal else 'exists'
     connective = 'implies' if is_universal else 'and'
-    binders = [p.of for p in path.selectors[:-1]] + [atomic_binder]
-    for selector, x, scope in zip(reversed(path.selectors), reversed(binders), reversed(['start'] + binders[:-1])):
+    binders = [p.of for p in selectors[:-1]] + [atomic_binder]
+    for selector, x, scope in zip(reversed(selectors), reversed(binders), reversed(['start'] + binders[:-1])):
         match selector:
             case XPathSelectDirectAt(symbol, pos):
                 formula = (f'(exists <{symbol}> {x} in {scope}: '
@@ -312,7 +430,8 @@ def xpath_to_isla_formula(path: XPath, is_universal: bool, atomic_binder: str, a
                            f'({EBNF_DIRECT_CHILD.name}({x}, {scope}) {connective} {formula}))')
             case XPathSelectAllIndirect(symbol):
                 formula = f'({quantifier} <{symbol}> {x} in {scope}: {formula})'
-    return formula
+    prefix, suffix = formula.split('\0')
+    return prefix, suffix
 
 
 def xpath_to_isla_expr(path: XPath, start: str) -> str:
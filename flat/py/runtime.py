@@ -1,17 +1,19 @@
-import ast
 import importlib.util
-import inspect
 import sys
 import time
+from itertools import islice, repeat
 from types import TracebackType
-from typing import Any, Callable, Generator, Optional, get_args
+from typing import Any, Callable, Generator, Optional, Tuple, get_args
 
+from isla.isla_predicates import STANDARD_SEMANTIC_PREDICATES
+from isla.language import Formula, parse_isla
 from isla.solver import ISLaSolver
+from isla.type_defs import Grammar as ISLaGrammar
 
 from flat.py import FuzzReport
 from flat.py.errors import *
 from flat.py.isla_extensions import *
-from flat.typing import Type, value_has_type, LangType, ListType
+from flat.typing import Type, value_has_type, LangType, ListType, BuiltinType, RefinementType, builtin_classes
 
 
 def load_source_module(path: str) -> None:
@@ -22,21 +24,60 @@ def load_source_module(path: str) -> None:
 
 
 def has_type(obj: Any, expected: Any) -> bool:
-    if isinstance(expected, Type):
-        match obj:
-            case (int() | bool() | str()) as v:
-                return value_has_type(v, expected)
-            case list() as xs:
-                match expected:
-                    case ListType(t):
-                        return all(has_type(x, t) for x in xs)
-                    case _:
-                        return False
-            case _:
-                raise RuntimeError(f'cannot check type for object {obj} with type {type(obj)}')
-    else:  # Literal
-        values = get_args(expected)
-        return obj in values
+    if isinstance(expected, BuiltinType) and type(obj) in _value_classes:  # fast path: nothing else to check
+        return isinstance(obj, builtin_classes[expected])
+    if not isinstance(expected, Type):  # Literal
+        return obj in get_args(expected)
+    # a type alias is passed as the same object at every check: specialize the check for it once
+    entry = _type_checks.get(id(expected))
+    if entry is None or entry[0] is not expected:
+        if len(_type_checks) >= _MAX_TYPE_CHECKS:  # inline annotations build a new type per check: start afresh
+            _type_checks.clear()
+        entry = _type_checks[id(expected)] = expected, compile_check(expected)
+    return entry[1](obj)
+
+
+_MAX_TYPE_CHECKS = 1024
+
+# id of type -> (type, its specialized check)
+_type_checks: dict[int, Tuple[Any, Callable[[Any], bool]]] = {}
+
+
+def compile_check(expected: Type) -> Callable[[Any], bool]:
+    """Specialize `has_type` for an expected type. Values of the common classes are checked directly,
+    the others go through the generic `check_type_of`."""
+    match expected:
+        case BuiltinType():
+            cls = builtin_classes[expected]
+            return lambda obj: isinstance(obj, cls) if type(obj) in _value_classes else check_type_of(obj, expected)
+        case LangType(grammar):
+            return lambda obj: obj in grammar if type(obj) is str else check_type_of(obj, expected)
+        case RefinementType(base, cond):
+            check_base = compile_check(base)
+            return lambda obj: ((check_base(obj) and cond.apply(obj)) if type(obj) in _value_classes
+                                else check_type_of(obj, expected))
+        case _:
+            return lambda obj: check_type_of(obj, expected)
+
+
+_value_classes = frozenset({int, bool, str})
+
+
+def check_type_of(obj: Any, expected: Type) -> bool:
+    match obj:
+        case (int() | bool() | str()) as v:
+            return value_has_type(v, expected)
+        case list() as xs:
+            match expected:
+                case ListType(BuiltinType() as t):  # one isinstance per element, as in the fast path
+                    cls = builtin_classes[t]
+                    return all(isinstance(x, cls) for x in xs)
+                case ListType(t):
+                    return all(has_type(x, t) for x in xs)
+                case _:
+                    return False
+        case _:
+            raise RuntimeError(f'cannot check type for object {obj} with type {type(obj)}')
 
 
 def assert_type(value: Any, value_loc: Loc, expected_type: Type):
@@ -49,29 +90,32 @@ def assert_arg_type(value: Any, k: int, of_method: str, expected_type: Type):
         raise ArgTypeMismatch(str(expected_type), show_value(value), k, of_method)
 
 
-def assert_pre(cond: bool, args: list[Tuple[str, Any]], of_method: str):
+def assert_pre(cond: bool, arg_names: Tuple[str, ...], arg_values: Tuple[Any, ...], of_method: str):
     if not cond:
-        raise PreconditionViolated(of_method, [(name, show_value(v)) for name, v in args])
+        raise PreconditionViolated(of_method, [(name, show_value(v)) for name, v in zip(arg_names, arg_values)])
 
 
-def assert_post(cond: bool, args: list[Tuple[str, Any]], return_value: Any, return_value_loc: Loc, of_method: str):
+def assert_post(cond: bool, arg_names: Tuple[str, ...], arg_values: Tuple[Any, ...],
+                return_value: Any, return_value_loc: Loc, of_method: str):
     if not cond:
-        raise PostconditionViolated(of_method, [(name, show_value(v)) for name, v in args],
+        raise PostconditionViolated(of_method, [(name, show_value(v)) for name, v in zip(arg_names, arg_values)],
                                     show_value(return_value), return_value_loc)
 
 
 class ExpectExceptions:
-    def __init__(self, exc_info: list[Tuple[bool, type[BaseException], Loc]]) -> None:
+    __slots__ = ('expected_type', 'loc')
+
+    def __init__(self, exc_info: Tuple[Tuple[bool, type[BaseException], Loc], ...]) -> None:
         """Expect a specified type of exception if its condition is held.
         Assuming the conditions are disjoint."""
-        self.expected_type: Optional[type] = None
-        self.loc: Optional[Loc] = None
-
         for b, exc_type, loc in exc_info:
-            if b:
-                self.expected_type = exc_type
-                self.loc = loc
-                break
+            if b:  # the first condition that holds decides: the rest are not inspected
+                self.expected_type: Optional[type] = exc_type
+                self.loc: Optional[Loc] = loc
+                return
+
+        self.expected_type = None
+        self.loc = None
 
     def __enter__(self) -> Any:
         return self
@@ -88,11 +132,9 @@ class ExpectExceptions:
 
 
 def show_value(value: Any):
-    match value:
-        case str() as s:
-            return ast.unparse(ast.Constant(s))
-        case _:
-            return str(value)
+    if isinstance(value, str):
+        return repr(value)  # what `ast.unparse(ast.Constant(value))` prints, without building the AST
+    return str(value)
 
 
 Gen = Generator[Any, None, None]
@@ -108,83 +150,83 @@ def choice_generator(choices: list[Any]) -> Gen:
         yield value
 
 
+_STRUCTURAL_PREDICATES = frozenset({EBNF_DIRECT_CHILD, EBNF_KTH_CHILD})
+
+# (id of grammar, formula) -> (grammar, parsed formula), so that each formula is parsed once per grammar
+_isla_formulas: dict[Tuple[int, str], Tuple[ISLaGrammar, Formula]] = {}
+
+
+def parse_isla_formula(grammar: ISLaGrammar, formula: str) -> Formula:
+    key = (id(grammar), formula)
+    entry = _isla_formulas.get(key)
+    if entry is None or entry[0] is not grammar:
+        entry = grammar, parse_isla(formula, grammar, _STRUCTURAL_PREDICATES,
+                                    STANDARD_SEMANTIC_PREDICATES)
+        _isla_formulas[key] = entry
+    return entry[1]
+
+
 def isla_generator(typ: LangType, formula: Optional[str] = None) -> Gen:
     assert typ is not None
+    grammar = typ.grammar.isla_solver.grammar
+    if formula is not None:  # parsed once, shared by the solvers below
+        formula = parse_isla_formula(grammar, formula)
     volume = 10
-    solver = ISLaSolver(typ.grammar.isla_solver.grammar, formula,
-                        structural_predicates={EBNF_DIRECT_CHILD, EBNF_KTH_CHILD},
+    solver = ISLaSolver(grammar, formula, structural_predicates=_STRUCTURAL_PREDICATES,
                         max_number_free_instantiations=volume)
     while True:
         try:
             yield solver.solve().to_string()
         except StopIteration:
             volume *= 2
-            solver = ISLaSolver(typ.grammar.isla_solver.grammar, formula,
-                                structural_predicates={EBNF_DIRECT_CHILD, EBNF_KTH_CHILD},
+            solver = ISLaSolver(grammar, formula, structural_predicates=_STRUCTURAL_PREDICATES,
                                 max_number_free_instantiations=volume)
 
 
 def producer(generator: Gen, test: Callable[[Any], bool]) -> Gen:
-    while True:
-        try:
-            value = next(generator)
-        except StopIteration:
-            break
-        if test(value):
-            yield value
+    yield from filter(test, generator)  # stops with the generator, no StopIteration handled per value
 
 
-def product_producer(producers: list[Gen], test: Callable[[Any], bool]) -> Gen:
-    while True:
-        try:
-            values = [next(p) for p in producers]
-        except StopIteration:
-            break
-        if test(*values):
-            yield values
+def product_producer(producers: list[Gen], test: Optional[Callable[..., bool]] = None) -> Gen:
+    # `zip` stops as soon as any producer does; with no params, every input is the empty tuple
+    values_stream = zip(*producers) if producers else repeat(())
+    if test is None:
+        yield from values_stream
+    else:
+        for values in values_stream:  # kept as is by the records of `fuzz`
+            if test(*values):
+                yield values
 
 
-def fuzz(target: Callable, times: int, args_producer: Gen, verbose: bool = False) -> FuzzReport:
-    # copy __source__, __line__ from the last frame
-    frame = inspect.currentframe()
-    back_frame = frame.f_back
-    if '__line__' in back_frame.f_locals:
-        frame.f_locals['__line__'] = back_frame.f_locals['__line__']
-        frame.f_globals['__source__'] = back_frame.f_globals['__source__']
+def fuzz(target: Callable, times: int, args_producer: Gen, verbose: bool = False, *,
+         source: Optional[str] = None, line: Optional[int] = None) -> FuzzReport:
+    global __source__
+    if line is not None:  # the call site passes its __source__, __line__
+        __source__ = source
+        # not dead: `errors._extract_stack` reads `__line__` from the f_locals of each frame in a traceback
+        __line__ = line
 
-    producer_time = 0.0
-    exe_time = 0.0
-    records = []
-    for i in range(times):
-        try:
-            t = time.process_time()
-            inputs = next(args_producer)
-            producer_time += (time.process_time() - t)
-        except StopIteration:
-            break
+    # produce all inputs up front, so that one measurement covers each phase
+    t = time.process_time()
+    inputs_list = [inputs if type(inputs) is tuple else tuple(inputs) for inputs in islice(args_producer, times)]
+    producer_time = time.process_time() - t
 
-        t = time.process_time()
+    records = []
+    t = time.process_time()
+    for inputs in inputs_list:
         try:
             target(*inputs)
-        except Error as err:
-            exe_time += (time.process_time() - t)
-            records.append((tuple(inputs), 'Error'))
-            # cprint(f'[Error] {target.__name__}{tuple(inputs)}', 'red')
-            # err.print()
-        except Exception as exc:
-            exe_time += (time.process_time() - t)
-            records.append((tuple(inputs), 'Error'))
-            # cprint(f'[Error] {target.__name__}{tuple(inputs)}', 'red')
-            # cprint('{}: {}'.format(type(exc).__name__, exc), 'red')
-        except SystemExit:
-            exe_time += (time.process_time() - t)
-            records.append((tuple(inputs), 'Exited'))
-            # cprint(f'[Exited] {target.__name__}{tuple(inputs)}', 'red')
-        else:
-            exe_time += (time.process_time() - t)
-            records.append((tuple(inputs), 'OK'))
+            status = 'OK'
             # if verbose:
-            #     cprint(f'[OK] {target.__name__}{tuple(inputs)}', 'green')
+            #     cprint(f'[OK] {target.__name__}{inputs}', 'green')
+        except SystemExit:
+            status = 'Exited'
+            # cprint(f'[Exited] {target.__name__}{inputs}', 'red')
+        except Exception:  # including Error
+            status = 'Error'
+            # cprint(f'[Error] {target.__name__}{inputs}', 'red')
+        records.append((inputs, status))
+    exe_time = time.process_time() - t
 
     # print(f'{target.__name__}: {passed[target.__name__]}/{times} passed, {total_time[target.__name__]} ms')
     return FuzzReport(target.__name__, records, producer_time, exe_time)
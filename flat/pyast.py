@@ -0,0 +1,9 @@
+import ast
+
+# expression contexts are stateless, so share them like the Python parser does
+LOAD = ast.Load()
+STORE = ast.Store()
+
+
+def load(name: str) -> ast.Name:
+    return ast.Name(name, ctx=LOAD)
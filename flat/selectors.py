@@ -1,33 +1,31 @@
 from dataclasses import dataclass
+from functools import lru_cache
 
 from isla.derivation_tree import DerivationTree
-from isla.helpers import is_nonterminal
 from parsy import string, seq, decimal_digit, regex
 
 from flat.typing import LangType
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class XPathSelector:
     of: str
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class XPathSelectDirectAt(XPathSelector):
     k: int  # k-th, where k >= 1
 
 
 class XPathSelectAllDirect(XPathSelector):
-    pass
+    __slots__ = ()
 
 
 class XPathSelectAllIndirect(XPathSelector):
-    pass
+    __slots__ = ()
 
 
-ident_start = regex(r'[_a-zA-Z]')
-ident_rest = ident_start | decimal_digit | string("'")
-ident_name = seq(ident_start, ident_rest.many()).combine(lambda c, cs: ''.join([c] + cs))
+ident_name = regex(r"[_a-zA-Z][_a-zA-Z0-9']*")  # one compiled pattern matches the whole identifier
 
 xpath_select_direct_at = string('.') >> seq(
     ident_name, string('[') >> decimal_digit.map(int) << string(']')).combine(XPathSelectDirectAt)
@@ -36,6 +34,12 @@ xpath_select_all_indirect = string('..') >> ident_name.map(XPathSelectAllIndirec
 xpath_parser = (xpath_select_direct_at | xpath_select_all_direct | xpath_select_all_indirect).at_least(1)
 
 
+@lru_cache(maxsize=1024)
+def parse_xpath(selector: str) -> list[XPathSelector]:
+    """Parse a selector; the result is shared by all parses of the same selector, so do not mutate it."""
+    return xpath_parser.parse(selector)
+
+
 @dataclass
 class XPath:
     language: LangType
@@ -43,17 +47,21 @@ class XPath:
 
 
 def children_labelled_with(tree: DerivationTree, symbol: str) -> list[DerivationTree]:
-    nonterminal = f'<{symbol}>'
     children = []
-    for node in tree.children:
-        if is_nonterminal(node.value):
-            if node.value.startswith('<-'):  # intermediate node: skip and collect in its children
-                children += children_labelled_with(node, nonterminal)
-            elif node.value == nonterminal:
-                children += [node]
+    _collect_children(tree, f'<{symbol}>', children)
     return children
 
 
+def _collect_children(tree: DerivationTree, nonterminal: str, children: list[DerivationTree]) -> None:
+    """Append the children of `tree` labelled with `nonterminal` to `children`, in one pass over each level."""
+    for node in tree.children:
+        value = node.value
+        if value == nonterminal:
+            children.append(node)
+        elif value.startswith('<-') and value[-1] == '>':  # intermediate node: collect in its children
+            _collect_children(node, nonterminal, children)
+
+
 def select_by_xpath(tree: DerivationTree, path: XPath) -> list[DerivationTree]:
     old = [tree]
     for selector in path.selectors:
@@ -61,17 +69,22 @@ def select_by_xpath(tree: DerivationTree, path: XPath) -> list[DerivationTree]:
         if len(old) == 0:
             return []
 
-        for parent in old:
-            match selector:
-                case XPathSelectDirectAt(symbol, k):
-                    candidates = children_labelled_with(parent, symbol)
+        # the label (and test) is the same for every parent: build it once per step
+        nonterminal = f'<{selector.of}>'
+        match selector:
+            case XPathSelectDirectAt(_, k):
+                for parent in old:
+                    candidates = []
+                    _collect_children(parent, nonterminal, candidates)
                     if len(candidates) >= k:
                         new.append(candidates[k - 1])
-                case XPathSelectAllDirect(symbol):
-                    new += children_labelled_with(parent, symbol)
-                case XPathSelectAllIndirect(symbol):
-                    nonterminal = f'<{symbol}>'
-                    new += [node for _, node in parent.filter(lambda node: node.value == nonterminal)]
+            case XPathSelectAllDirect():
+                for parent in old:
+                    _collect_children(parent, nonterminal, new)
+            case XPathSelectAllIndirect():
+                is_labelled = lambda node: node.value == nonterminal
+                for parent in old:
+                    new += [node for _, node in parent.filter(is_labelled)]
         old = new
 
     return old
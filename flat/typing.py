@@ -1,7 +1,7 @@
 import abc
 from dataclasses import dataclass
 from enum import Enum
-from typing import Union
+from typing import Callable, Union
 
 from flat.grammars import Grammar
 
@@ -15,13 +15,15 @@ class Cond:
 
 
 class Type:
+    __slots__ = ()
+
     @property
     def is_lang_type(self) -> bool:
         return False
 
 
 class BaseType(Type):
-    pass
+    __slots__ = ()
 
 
 class BuiltinType(BaseType, Enum):
@@ -30,7 +32,7 @@ class BuiltinType(BaseType, Enum):
     String = 2
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class LangType(BaseType):
     grammar: Grammar
 
@@ -41,7 +43,7 @@ class LangType(BaseType):
         return self.grammar.name
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class RefinementType(Type):
     base: BaseType
     cond: Cond
@@ -61,7 +63,7 @@ class LiteralType(Type):
         return 'Literal[' + ', '.join(map(str, self.values)) + ']'
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class ListType(Type):
     elem_type: Type
 
@@ -82,17 +84,33 @@ def get_base_type(typ: Type) -> BuiltinType:
             return get_base_type(b)
 
 
+builtin_classes: dict[BuiltinType, type] = {
+    BuiltinType.Int: int,
+    BuiltinType.Bool: bool,
+    BuiltinType.String: str
+}
+
+
+def _builtin_has(value: Value, typ: BuiltinType) -> bool:
+    return isinstance(value, builtin_classes[typ])
+
+
+def _lang_has(value: Value, typ: LangType) -> bool:
+    return isinstance(value, str) and value in typ.grammar
+
+
+def _refinement_has(value: Value, typ: RefinementType) -> bool:
+    return value_has_type(value, typ.base) and typ.cond.apply(value)
+
+
+# class of type -> its check: one dict lookup instead of trying each case pattern in turn
+_value_checks: dict[type, Callable[[Value, Type], bool]] = {
+    BuiltinType: _builtin_has,
+    LangType: _lang_has,
+    RefinementType: _refinement_has
+}
+
+
 def value_has_type(value: Value, typ: Type) -> bool:
-    match value, typ:
-        case int(), BuiltinType.Int:
-            return True
-        case bool(), BuiltinType.Bool:
-            return True
-        case str(), BuiltinType.String:
-            return True
-        case str() as word, LangType(grammar):
-            return word in grammar
-        case value, RefinementType(base, cond):
-            return value_has_type(value, base) and cond.apply(value)
-        case _:
-            return False
+    check = _value_checks.get(type(typ))
+    return check is not None and check(value, typ)
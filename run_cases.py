@@ -1,9 +1,20 @@
 import os
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
 
 PAPER_FOLDER = 'examples/paper/'
 
-for f in os.listdir(PAPER_FOLDER):
-    if f.endswith('.py'):
-        print(f'# {f}')
-        os.system(f'python -m flat.py {os.path.join(PAPER_FOLDER, f)}')
-        os.system(f'python examples/out/{f} examples/out/{f[:-3]}.log')
+
+def run(f: str) -> str:
+    """Instrument and run a case, and return what it printed: cases run in parallel, but print in order."""
+    output = f'# {f}\n'
+    for argv in ([sys.executable, '-m', 'flat.py', os.path.join(PAPER_FOLDER, f)],
+                 [sys.executable, f'examples/out/{f}', f'examples/out/{f[:-3]}.log']):
+        output += subprocess.run(argv, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True).stdout
+    return output
+
+
+with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+    for output in executor.map(run, [f for f in os.listdir(PAPER_FOLDER) if f.endswith('.py')]):
+        print(output, end='', flush=True)
@@ -1,9 +1,20 @@
 import os
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
 
 DEMO_FOLDER = 'examples/demo/'
 
-for f in os.listdir(DEMO_FOLDER):
-    if f.endswith('.py'):
-        print(f'# {f}')
-        os.system(f'python -m flat.py {os.path.join(DEMO_FOLDER, f)}')
-        os.system(f'python examples/out/{f}')
+
+def run(f: str) -> str:
+    """Instrument and run a demo, and return what it printed: demos run in parallel, but print in order."""
+    output = f'# {f}\n'
+    for argv in ([sys.executable, '-m', 'flat.py', os.path.join(DEMO_FOLDER, f)],
+                 [sys.executable, f'examples/out/{f}']):
+        output += subprocess.run(argv, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True).stdout
+    return output
+
+
+with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+    for output in executor.map(run, [f for f in os.listdir(DEMO_FOLDER) if f.endswith('.py')]):
+        print(output, end='', flush=True)